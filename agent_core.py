@@ -8,7 +8,12 @@ import sys
 import requests 
 import random 
 import re 
+import json
 import threading 
+import queue
+import cProfile
+import pstats
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # ★ 排他制御用ロックの定義 (トップレベル)
 PROCESS_LOCK = threading.Lock() 
 
@@ -17,6 +22,7 @@ from dotenv import load_dotenv
 import pyaudio
 import speech_recognition as sr 
 from ibm_watson import SpeechToTextV1, TextToSpeechV1
+from ibm_watson.websocket import RecognizeCallback, AudioSource
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from openai import OpenAI 
 from faster_whisper import WhisperModel 
@@ -40,13 +46,25 @@ stt_service = None; tts_service = None; openai_client = None; whisper_local_mode
 DIFY_API_KEY = None; DIFY_APP_ID = None; DIFY_BASE_URL = None; DIFY_USER_ID = None
 WATSON_STT_API_KEY = None; WATSON_STT_URL = None; WATSON_TTS_API_KEY = None; WATSON_TTS_URL = None
 WATSON_TTS_VOICE = None; WATSON_STT_MODEL = None; VOICEVOX_BASE_URL = None; VOICEVOX_SPEAKER_ID = "3"
-OPENAI_API_KEY = None; WHISPER_LOCAL_MODEL = None
+OPENAI_API_KEY = None; WHISPER_LOCAL_MODEL = None; WHISPER_COMPUTE_TYPE = "int8"; WHISPER_CPU_THREADS = 0
 ENABLE_WHISPER_LOCAL = False; ENABLE_WATSON_STT = False; ENABLE_OPENAI_STT = False
 ENABLE_VOICEVOX = False; ENABLE_WATSON_TTS = False; ENABLE_DIFY = False
 QUIET_KEYWORD = None; STT_WATSON_NO_SPEECH_MSG = None; STT_OPENAI_NO_SPEECH_MSG = None
 WAKE_WORD_SET = set(); WAKE_WORD_DISPLAY = 'キーワード'
 IDLE_SENTENCES = []; HUM_SENTENCES = []
 
+# ★ Watson STT ストリーミング (WebSocket) 関連のグローバル変数
+ENABLE_WATSON_STT_STREAMING = False
+WATSON_STT_END_OF_PHRASE_SILENCE = 0.4
+WATSON_STT_UTTERANCE_END_GRACE = 0.5  # 最終結果の後、続きの発話を待つ時間 (秒)
+WATSON_STREAMING_RATE = 16000; WATSON_STREAMING_CHUNK = 1024
+WATSON_STREAMING_MAX_FAILURES = 5  # 連続失敗がこの回数に達したらストリーミングを無効化する
+_watson_streaming_failures = 0; _watson_streaming_retry_at = 0.0
+
+# ★ STTベンチマーク用の発話コーパス録音 (空の場合は録音しない)
+STT_CORPUS_DIR = None
+_last_corpus_meta_path = None
+
 # ★ Outgoing Webhook 関連のグローバル変数
 OUTGOING_WEBHOOK_URL = None
 ENABLE_OUTGOING_WEBHOOK = False
@@ -54,6 +72,17 @@ OUTGOING_WEBHOOK_AUTH_TOKEN = None
 OUTGOING_WEBHOOK_TIMEOUT = 10
 OUTGOING_WEBHOOK_RETRY_COUNT = 3
 
+# ★ プロファイリング (管理者用) 関連のグローバル変数
+ADMIN_API_TOKEN = None
+PROFILE_MAX_SECONDS = 300
+PROFILE_STATS_LIMIT = 40
+PROFILE_DEFAULT_INTERVAL = 0.03  # サンプリング間隔 (秒)。短すぎるとGIL競合そのものを歪める
+
+# ★ バッチ問い合わせ関連のグローバル変数
+BATCH_MAX_CONCURRENCY = 4
+BATCH_MAX_ITEMS = 100
+BATCH_DIFY_SEMAPHORE = threading.BoundedSemaphore(BATCH_MAX_CONCURRENCY)  # 全バッチ合計の同時問い合わせ数
+
 # 共通リソース (必ず関数外で初期化)
 TEMP_AUDIO_FILE = "user_input.wav"
 r = sr.Recognizer(); p = pyaudio.PyAudio() 
@@ -68,7 +97,7 @@ def initialize_global_state():
     # ★ 必須: すべてのグローバル変数を明示的に宣言し、値を代入
     global DIFY_API_KEY, DIFY_APP_ID, DIFY_BASE_URL, DIFY_USER_ID, WATSON_STT_API_KEY, WATSON_STT_URL, WATSON_TTS_API_KEY
     global WATSON_TTS_URL, WATSON_TTS_VOICE, WATSON_STT_MODEL, VOICEVOX_BASE_URL, VOICEVOX_SPEAKER_ID
-    global OPENAI_API_KEY, WHISPER_LOCAL_MODEL, ENABLE_WHISPER_LOCAL, ENABLE_WATSON_STT, ENABLE_OPENAI_STT
+    global OPENAI_API_KEY, WHISPER_LOCAL_MODEL, WHISPER_COMPUTE_TYPE, WHISPER_CPU_THREADS, ENABLE_WHISPER_LOCAL, ENABLE_WATSON_STT, ENABLE_OPENAI_STT
     global ENABLE_VOICEVOX, ENABLE_WATSON_TTS, ENABLE_DIFY, WAKE_WORDS_LIST, QUIET_KEYWORD, QUIET_DURATION_MINUTES
     global STT_WATSON_NO_SPEECH_MSG, STT_OPENAI_NO_SPEECH_MSG, IDLE_CHAT_INTERVAL_SECONDS, IDLE_SENTENCES, HUM_SENTENCES
     global WAKE_WORD_SET, WAKE_WORD_DISPLAY
@@ -77,6 +106,14 @@ def initialize_global_state():
     # ★ Outgoing Webhook用のグローバル変数を追加
     global OUTGOING_WEBHOOK_URL, ENABLE_OUTGOING_WEBHOOK, OUTGOING_WEBHOOK_AUTH_TOKEN
     global OUTGOING_WEBHOOK_TIMEOUT, OUTGOING_WEBHOOK_RETRY_COUNT
+    # ★ 管理者用エンドポイントの認証トークン
+    global ADMIN_API_TOKEN
+    # ★ Watson STT ストリーミング用のグローバル変数
+    global ENABLE_WATSON_STT_STREAMING, WATSON_STT_END_OF_PHRASE_SILENCE, WATSON_STT_UTTERANCE_END_GRACE
+    # ★ 発話コーパス録音用のグローバル変数
+    global STT_CORPUS_DIR
+    # ★ バッチ問い合わせ用のグローバル変数
+    global BATCH_MAX_CONCURRENCY, BATCH_MAX_ITEMS, BATCH_DIFY_SEMAPHORE
 
     try:
         # --- 環境変数の読み込みと代入 (安全な読み込み) ---
@@ -88,12 +125,19 @@ def initialize_global_state():
         WATSON_TTS_VOICE = os.getenv("WATSON_TTS_VOICE", "").strip(); WATSON_STT_MODEL = os.getenv("WATSON_STT_MODEL", "").strip()
         VOICEVOX_BASE_URL = os.getenv("VOICEVOX_BASE_URL", "").strip(); VOICEVOX_SPEAKER_ID = os.getenv("VOICEVOX_SPEAKER_ID", "3").strip()
         OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip(); WHISPER_LOCAL_MODEL = os.getenv("WHISPER_LOCAL_MODEL", "").strip()
+        WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8").strip() or "int8"; WHISPER_CPU_THREADS = int(os.getenv("WHISPER_CPU_THREADS", "0").strip() or "0")
+        STT_CORPUS_DIR = os.getenv("STT_CORPUS_DIR", "").strip()
 
         # --- サービス有効化フラグ ---
         ENABLE_WHISPER_LOCAL = os.getenv("ENABLE_WHISPER_LOCAL", "False").lower().strip() == 'true'; ENABLE_WATSON_STT = os.getenv("ENABLE_WATSON_STT", "False").lower().strip() == 'true'
         ENABLE_OPENAI_STT = os.getenv("ENABLE_OPENAI_STT", "False").lower().strip() == 'true'; ENABLE_VOICEVOX = os.getenv("ENABLE_VOICEVOX", "False").lower().strip() == 'true'
         ENABLE_WATSON_TTS = os.getenv("ENABLE_WATSON_TTS", "False").lower().strip() == 'true'; ENABLE_DIFY = os.getenv("ENABLE_DIFY", "True").lower().strip() == 'true'
 
+        # ★ Watson STT ストリーミング設定の読み込み
+        ENABLE_WATSON_STT_STREAMING = os.getenv("ENABLE_WATSON_STT_STREAMING", "False").lower().strip() == 'true'
+        WATSON_STT_END_OF_PHRASE_SILENCE = float(os.getenv("WATSON_STT_END_OF_PHRASE_SILENCE", "0.4").strip())
+        WATSON_STT_UTTERANCE_END_GRACE = float(os.getenv("WATSON_STT_UTTERANCE_END_GRACE", "0.5").strip())
+
         # ★ Outgoing Webhook 設定の読み込み
         OUTGOING_WEBHOOK_URL = os.getenv("OUTGOING_WEBHOOK_URL", "").strip()
         ENABLE_OUTGOING_WEBHOOK = os.getenv("ENABLE_OUTGOING_WEBHOOK", "False").lower().strip() == 'true'
@@ -101,6 +145,14 @@ def initialize_global_state():
         OUTGOING_WEBHOOK_TIMEOUT = int(os.getenv("OUTGOING_WEBHOOK_TIMEOUT", "10").strip())
         OUTGOING_WEBHOOK_RETRY_COUNT = int(os.getenv("OUTGOING_WEBHOOK_RETRY_COUNT", "3").strip())
 
+        # ★ 管理者トークン (空の場合は管理者用エンドポイントを無効化)
+        ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "").strip()
+
+        # ★ バッチ問い合わせ設定の読み込み
+        BATCH_MAX_CONCURRENCY = max(1, int(os.getenv("BATCH_MAX_CONCURRENCY", "4").strip()))
+        BATCH_MAX_ITEMS = max(1, int(os.getenv("BATCH_MAX_ITEMS", "100").strip()))
+        BATCH_DIFY_SEMAPHORE = threading.BoundedSemaphore(BATCH_MAX_CONCURRENCY)
+
         # 制御/メッセージ設定
         WAKE_WORDS_LIST = os.getenv("WAKE_WORDS_LIST", "AI").strip(); QUIET_KEYWORD = os.getenv("QUIET_KEYWORD", "静かにして").strip()
         QUIET_DURATION_MINUTES = int(os.getenv("QUIET_DURATION_MINUTES", "30").strip()); 
@@ -150,6 +202,9 @@ def initialize_global_state():
         if ENABLE_WATSON_STT and all([WATSON_STT_API_KEY, WATSON_STT_URL, WATSON_STT_MODEL]):
             stt_authenticator = IAMAuthenticator(WATSON_STT_API_KEY); stt_service = SpeechToTextV1(authenticator=stt_authenticator)
             stt_service.set_service_url(WATSON_STT_URL); print("INFO: IBM Watson STTサービスを有効にしました。")
+            if ENABLE_WATSON_STT_STREAMING: print("INFO: Watson STT ストリーミング (WebSocket) を有効にしました。")
+            if ENABLE_WATSON_STT_STREAMING and ENABLE_WHISPER_LOCAL:
+                print("警告: Watson STT ストリーミングが有効なため、ローカル Whisper より優先されます。(ローカル Whisper はストリーミング失敗時のフォールバックのみ)")
         if ENABLE_WATSON_TTS and all([WATSON_TTS_API_KEY, WATSON_TTS_URL, WATSON_TTS_VOICE]):
             tts_authenticator = IAMAuthenticator(WATSON_TTS_API_KEY); tts_service = TextToSpeechV1(authenticator=tts_authenticator)
             tts_service.set_service_url(WATSON_TTS_URL); print("INFO: IBM Watson TTSサービスを有効にしました。")
@@ -157,11 +212,16 @@ def initialize_global_state():
             openai_client = OpenAI(api_key=OPENAI_API_KEY); print("INFO: OpenAIクライアントを有効にしました。")
         if ENABLE_WHISPER_LOCAL and WHISPER_LOCAL_MODEL:
             try:
-                whisper_local_model = WhisperModel(WHISPER_LOCAL_MODEL, device="cpu", compute_type="int8")
-                print(f"INFO: ローカル Whisper ({WHISPER_LOCAL_MODEL}) サービスを有効にしました。(STT最優先)")
+                whisper_local_model = WhisperModel(WHISPER_LOCAL_MODEL, device="cpu", compute_type=WHISPER_COMPUTE_TYPE, cpu_threads=WHISPER_CPU_THREADS)
+                print(f"INFO: ローカル Whisper ({WHISPER_LOCAL_MODEL}, {WHISPER_COMPUTE_TYPE}) サービスを有効にしました。(STT最優先)")
             except Exception as e:
                 print(f"警告: ローカル Whisperの初期化に失敗しました。ローカル STT は無効化されます。詳細: {e}"); ENABLE_WHISPER_LOCAL = False
 
+        if STT_CORPUS_DIR:
+            print(f"INFO: 発話コーパスの録音を有効にしました。保存先: {STT_CORPUS_DIR}")
+            if ENABLE_WATSON_STT_STREAMING and ENABLE_WATSON_STT:
+                print("警告: Watson STT ストリーミング中は発話コーパスを録音しません。(ファイル方式にフォールバックしたターンのみ録音されます)")
+
         # 最終的な有効性チェック
         stt_active = (stt_service is not None) or (openai_client is not None) or (whisper_local_model is not None)
         tts_active = (VOICEVOX_BASE_URL) or (tts_service is not None)
@@ -253,12 +313,12 @@ def text_to_speech(text):
     return
 
 # --- STT 関連関数 (元の定義を使用) ---
-def whisper_speech_to_text(audio_file_path):
+def whisper_speech_to_text(audio_file_path, vad_filter=True):
     """ローカル Whisper (faster-whisper) を使用して音声ファイルからテキストに変換する"""
     global whisper_local_model
     if not whisper_local_model: return None
     try:
-        segments, info = whisper_local_model.transcribe(audio_file_path, language="ja", vad_filter=True)
+        segments, info = whisper_local_model.transcribe(audio_file_path, language="ja", vad_filter=vad_filter)
         segments_list = list(segments)
         if segments_list:
             user_input = " ".join([segment.text for segment in segments_list]).strip()
@@ -320,6 +380,214 @@ def speech_to_text(audio_file_path):
         except OSError:
             pass 
 
+def _normalize_wake_text(text):
+    """起動キーワード判定用に小文字化し、Watsonの単語間スペースを除去する"""
+    return re.sub(r"\s+", "", text.lower())
+
+def _strip_wake_word(text, wake_word):
+    """先頭の起動キーワードを (単語間スペースを無視して) 取り除き、残りの本文を返す"""
+    remaining = len(_normalize_wake_text(wake_word))
+    for i, ch in enumerate(text):
+        if remaining == 0: return text[i:].strip()
+        if not ch.isspace(): remaining -= 1
+    return ""
+
+def _is_wake_word_only(text):
+    """認識結果が起動キーワードのみ (本文なし) かを判定する"""
+    normalized = _normalize_wake_text(text)
+    return any(normalized == _normalize_wake_text(w) for w in WAKE_WORD_SET)
+
+class _WatsonStreamingCallback(RecognizeCallback):
+    """Watson STT (WebSocket) の途中結果と最終結果を受け取るコールバック"""
+
+    def __init__(self):
+        RecognizeCallback.__init__(self)
+        self.done = threading.Event()
+        self.final_parts = []; self.interim_text = ""
+        self.wake_word_confirmed = False; self.wake_word_rejected = False
+        self.error = None
+        self.last_result_at = time.time()
+        # 途中結果がこの文字数に達しても起動キーワードで始まらなければ、最終結果を待たずに打ち切る
+        self.reject_length = max((len(_normalize_wake_text(w)) for w in WAKE_WORD_SET), default=0) + 2
+
+    def transcript(self):
+        return " ".join(self.final_parts + ([self.interim_text] if self.interim_text else [])).strip()
+
+    def utterance_complete(self, grace):
+        """
+        最終結果の後、grace 秒間新しい途中結果が届かなければ発話終了とみなす
+        (end_of_phrase_silence_time で区切られた文中の間で、残りの発話を取りこぼさないため)
+        """
+        if self.interim_text or not self.final_parts: return False
+        if _is_wake_word_only(self.transcript()): return False  # 起動キーワードの後の本文を待つ
+        return time.time() - self.last_result_at >= grace
+
+    def on_data(self, data):
+        results = data.get('results')
+        if not results or not results[0].get('alternatives'): return
+        text = results[0]['alternatives'][0]['transcript'].strip()
+        self.last_result_at = time.time()
+
+        # ★ 途中結果の段階で起動キーワードを判定する
+        # 確認できた発話は最後まで認識し、明らかに含まない発話はその場で打ち切ってマイク待機に戻る
+        if not self.wake_word_confirmed and not self.final_parts:
+            normalized = _normalize_wake_text(text)
+            if any(normalized.startswith(_normalize_wake_text(w)) for w in WAKE_WORD_SET):
+                self.wake_word_confirmed = True
+                print(f"⚡ Watson STT (途中結果): 起動キーワードを検出しました。 ({text})")
+            elif len(normalized) >= self.reject_length:
+                self.wake_word_rejected = True; self.interim_text = text
+                self.done.set(); return
+
+        if results[0].get('final'):
+            # 発話終了の判定は utterance_complete() で行う (最初の最終結果では打ち切らない)
+            self.final_parts.append(text); self.interim_text = ""
+        else:
+            self.interim_text = text
+
+    def on_error(self, error):
+        print(f"警告: Watson STT ストリーミング通信に失敗しました。詳細: {error}")
+        self.error = error; self.done.set()
+
+    def on_inactivity_timeout(self, error):
+        self.done.set()
+
+    def on_close(self):
+        self.done.set()
+
+def _record_watson_streaming_result(failed):
+    """ストリーミングの成否を記録し、連続失敗時はバックオフ、上限到達で無効化する"""
+    global _watson_streaming_failures, _watson_streaming_retry_at, ENABLE_WATSON_STT_STREAMING
+    if not failed:
+        _watson_streaming_failures = 0; return
+    _watson_streaming_failures += 1
+    if _watson_streaming_failures >= WATSON_STREAMING_MAX_FAILURES:
+        ENABLE_WATSON_STT_STREAMING = False
+        print(f"警告: Watson STT ストリーミングが{_watson_streaming_failures}回連続で失敗したため無効化しました。以降はファイル方式のSTTを使用します。")
+        return
+    backoff = min(2 ** _watson_streaming_failures, 60)
+    _watson_streaming_retry_at = time.time() + backoff
+    print(f"警告: Watson STT ストリーミングに失敗しました。{backoff}秒間はファイル方式のSTTを使用します。")
+
+def watson_streaming_available():
+    """Watson STT ストリーミングを今回のマイク入力で使用するかを判定する (バックオフ中は False)"""
+    return ENABLE_WATSON_STT_STREAMING and ENABLE_WATSON_STT and stt_service is not None and time.time() >= _watson_streaming_retry_at
+
+def _write_streaming_fallback_wav(frames):
+    """ストリーミング中に録音済みのPCM (16kHz/mono/16bit) を TEMP_AUDIO_FILE に書き出す"""
+    try:
+        with wave.open(TEMP_AUDIO_FILE, "wb") as wf:
+            wf.setnchannels(1); wf.setsampwidth(p.get_sample_size(pyaudio.paInt16)); wf.setframerate(WATSON_STREAMING_RATE)
+            wf.writeframes(b"".join(frames))
+        return TEMP_AUDIO_FILE
+    except Exception as e:
+        print(f"警告: フォールバック用の録音ファイル作成に失敗しました。詳細: {e}"); return None
+
+def watson_streaming_speech_to_text(speech_timeout=5, phrase_time_limit=10):
+    """
+    マイク音声を Watson STT (WebSocket) へ逐次送信し、発話終了直後に最終結果を返す
+    
+    Returns:
+        tuple: (認識テキストまたはNone, 通信失敗時True, フォールバック用WAVのパスまたはNone)
+               通信失敗時は途中結果を破棄し、録音済みの音声を呼び出し元で speech_to_text に渡す
+    """
+    global p
+    if not stt_service: return None, True, None
+
+    audio_queue = queue.Queue()
+    audio_source = AudioSource(audio_queue, is_recording=True, is_buffer=True)
+    callback = _WatsonStreamingCallback()
+    captured_frames = []  # 通信失敗時に同じ発話をファイル方式で認識し直すための控え
+
+    def _on_audio(in_data, frame_count, time_info, status):
+        captured_frames.append(in_data); audio_queue.put(in_data); return (None, pyaudio.paContinue)
+
+    def _recognize(**kwargs):
+        try: stt_service.recognize_using_websocket(**kwargs)
+        except Exception as e: callback.on_error(e)
+
+    stream = None; recognize_thread = None
+    try:
+        stream = p.open(format=pyaudio.paInt16, channels=1, rate=WATSON_STREAMING_RATE, input=True,
+                        frames_per_buffer=WATSON_STREAMING_CHUNK, stream_callback=_on_audio)
+        recognize_thread = threading.Thread(
+            target=_recognize,
+            kwargs={
+                "audio": audio_source,
+                "content_type": f"audio/l16; rate={WATSON_STREAMING_RATE}",
+                "recognize_callback": callback,
+                "model": WATSON_STT_MODEL,
+                "interim_results": True,
+                "inactivity_timeout": speech_timeout,  # 無音が続いた場合はサーバー側で終了
+                "end_of_phrase_silence_time": WATSON_STT_END_OF_PHRASE_SILENCE
+            },
+            daemon=True,
+            name="watson-stt-stream"
+        )
+        recognize_thread.start()
+        deadline = time.time() + speech_timeout + phrase_time_limit
+        while not callback.done.wait(timeout=0.05):
+            if time.time() >= deadline or callback.utterance_complete(WATSON_STT_UTTERANCE_END_GRACE): break
+    except Exception as e:
+        print(f"警告: Watson STT ストリーミングの開始に失敗しました。詳細: {e}"); callback.error = e
+    finally:
+        # 録音を終了し、WebSocketに終了メッセージを送らせる
+        audio_source.completed_recording()
+        if stream is not None:
+            try: stream.stop_stream(); stream.close()
+            except Exception: pass
+        if recognize_thread is not None: recognize_thread.join(timeout=2)
+
+    # 途中で通信が切れた場合、途中結果は発話の一部でしかないため採用しない
+    failed = callback.error is not None
+    _record_watson_streaming_result(failed)
+    if failed:
+        fallback_path = _write_streaming_fallback_wav(captured_frames) if captured_frames else None
+        return None, True, fallback_path
+
+    user_input = callback.transcript()
+    if not user_input: print(STT_WATSON_NO_SPEECH_MSG); return None, False, None
+    return user_input, False, None
+
+def _save_corpus_utterance(audio, wav_data):
+    """録音した発話をベンチマーク用コーパス (WAV + メタデータJSON) として保存する"""
+    global _last_corpus_meta_path
+    _last_corpus_meta_path = None
+    if not STT_CORPUS_DIR: return
+    try:
+        os.makedirs(STT_CORPUS_DIR, exist_ok=True)
+        utterance_id = time.strftime("%Y%m%d-%H%M%S") + f"-{int(time.time() * 1000) % 1000:03d}"
+        with open(os.path.join(STT_CORPUS_DIR, f"{utterance_id}.wav"), "wb") as f: f.write(wav_data)
+
+        metadata = {
+            "id": utterance_id,
+            "recorded_at": time.time(),
+            "audio_file": f"{utterance_id}.wav",
+            "duration_sec": round(len(audio.frame_data) / (audio.sample_rate * audio.sample_width), 3),
+            "sample_rate": audio.sample_rate,
+            "sample_width": audio.sample_width,
+            "stt_transcript": None,   # 稼働中のSTTの認識結果 (annotate_corpus_utterance で追記)
+            "reference": None         # 正解テキスト (CER計測用に手動で記入する)
+        }
+        meta_path = os.path.join(STT_CORPUS_DIR, f"{utterance_id}.json")
+        with open(meta_path, "w", encoding="utf-8") as f: json.dump(metadata, f, ensure_ascii=False, indent=2)
+        _last_corpus_meta_path = meta_path
+    except Exception as e:
+        print(f"警告: 発話コーパスの保存に失敗しました。詳細: {e}")
+
+def annotate_corpus_utterance(transcript):
+    """直前に保存した発話のメタデータに、稼働中のSTTの認識結果を追記する"""
+    global _last_corpus_meta_path
+    if not _last_corpus_meta_path: return
+    try:
+        with open(_last_corpus_meta_path, "r", encoding="utf-8") as f: metadata = json.load(f)
+        metadata["stt_transcript"] = transcript
+        with open(_last_corpus_meta_path, "w", encoding="utf-8") as f: json.dump(metadata, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"警告: 発話コーパスのメタデータ更新に失敗しました。詳細: {e}")
+    finally:
+        _last_corpus_meta_path = None
+
 def recognize_speech_from_mic():
     """マイクから音声を録音し、WAVファイルとして保存する"""
     global r
@@ -328,16 +596,23 @@ def recognize_speech_from_mic():
         try:
             audio = r.listen(source, timeout=5, phrase_time_limit=10)
         except sr.WaitTimeoutError: return None
+        wav_data = audio.get_wav_data()  # WAVエンコードは1回だけ行い、一時ファイルとコーパスで共用する
+        _save_corpus_utterance(audio, wav_data)
         try:
-            with open(TEMP_AUDIO_FILE, "wb") as f: f.write(audio.get_wav_data()); return TEMP_AUDIO_FILE
+            with open(TEMP_AUDIO_FILE, "wb") as f: f.write(wav_data); return TEMP_AUDIO_FILE
         except Exception as e:
             print(f"警告: 録音ファイル作成に失敗しました。詳細: {e}"); return None
 
-def get_dify_response(prompt):
-    """Dify API (Chat App)にリクエストを送信し、応答を取得する (★ タイムアウトも捕捉し続行)"""
+def request_dify_answer(prompt):
+    """
+    Dify API (Chat App)にリクエストを送信し、成否と応答テキストを返す
     
-    if not ENABLE_DIFY: return "Difyサービスが無効化されているため、AI応答を生成できません。" 
-    if len(prompt) > MAX_PROMPT_LENGTH: return f"プロンプトが長すぎます。最大{MAX_PROMPT_LENGTH}文字までです。"
+    Returns:
+        tuple: (成功時True, 応答テキスト)。失敗時のテキストは発話用のフォールバックメッセージ
+    """
+    
+    if not ENABLE_DIFY: return False, "Difyサービスが無効化されているため、AI応答を生成できません。" 
+    if len(prompt) > MAX_PROMPT_LENGTH: return False, f"プロンプトが長すぎます。最大{MAX_PROMPT_LENGTH}文字までです。"
         
     sanitized_prompt = sanitize_prompt(prompt)
     chat_url = f"{DIFY_BASE_URL.rstrip('/')}/v1/chat-messages"
@@ -351,21 +626,26 @@ def get_dify_response(prompt):
         
         if data.get('answer'):
             final_answer = remove_thinking_tags(data['answer'])
-            if final_answer: return final_answer
-            return "Difyからの応答は思考ログのみでした。回答が生成されていません。"
-        return "Difyからの応答が空でした。Appの設定を確認してください。"
+            if final_answer: return True, final_answer
+            return False, "Difyからの応答は思考ログのみでした。回答が生成されていません。"
+        return False, "Difyからの応答が空でした。Appの設定を確認してください。"
         
     except requests.exceptions.Timeout:
         print(f"警告: Dify API通信がタイムアウトしました。")
-        return "ごめんなさい、Difyサービスが応答しませんでした。しばらくしてから再度呼びかけてください。"
+        return False, "ごめんなさい、Difyサービスが応答しませんでした。しばらくしてから再度呼びかけてください。"
         
     except requests.exceptions.RequestException as e:
         print(f"警告: Dify API通信に失敗しました。詳細: {e}")
-        return "ごめんなさい、Difyサーバーとの接続に失敗しました。ネットワークを確認してください。"
+        return False, "ごめんなさい、Difyサーバーとの接続に失敗しました。ネットワークを確認してください。"
         
     except Exception as e:
         print(f"警告: Dify応答処理中に予期せぬエラーが発生しました。詳細: {e}")
-        return "予期せぬエラーが発生し、応答できませんでした。システム管理者にお問い合わせください。"
+        return False, "予期せぬエラーが発生し、応答できませんでした。システム管理者にお問い合わせください。"
+
+def get_dify_response(prompt):
+    """Dify API (Chat App)にリクエストを送信し、応答を取得する (★ 失敗時も発話用のフォールバック文を返し続行)"""
+    _, answer = request_dify_answer(prompt)
+    return answer
 
 
 # ==========================================================
@@ -380,7 +660,7 @@ def send_outgoing_webhook(user_prompt, ai_response, user_id=None, source="mic"):
         user_prompt (str): ユーザーの入力テキスト
         ai_response (str): Difyからの応答テキスト
         user_id (str): ユーザーID (オプション)
-        source (str): 入力ソース ("mic" または "webhook")
+        source (str): 入力ソース ("mic", "webhook" または "batch")
     
     Returns:
         bool: 送信成功時True、失敗時False
@@ -397,7 +677,7 @@ def send_outgoing_webhook(user_prompt, ai_response, user_id=None, source="mic"):
     payload = {
         "timestamp": time.time(),
         "user_id": user_id or DIFY_USER_ID,
-        "source": source,  # "mic" or "webhook"
+        "source": source,  # "mic", "webhook" or "batch"
         "user_input": user_prompt,
         "ai_response": ai_response,
         "agent_version": "1.0"
@@ -455,7 +735,8 @@ def send_outgoing_webhook_async(user_prompt, ai_response, user_id=None, source="
     thread = threading.Thread(
         target=send_outgoing_webhook,
         args=(user_prompt, ai_response, user_id, source),
-        daemon=True
+        daemon=True,
+        name="outgoing-webhook"
     )
     thread.start()
 
@@ -503,6 +784,69 @@ def process_and_respond_core(user_prompt, user_id=None, source="mic"):
     return ai_response_text
 
 
+def _process_batch_item(index, item, send_webhook):
+    """バッチの1件をDifyに問い合わせる (TTSなし)"""
+    query = item.get('query') if isinstance(item, dict) else None
+    user_id = (item.get('user_id') if isinstance(item, dict) else None) or DIFY_USER_ID or "batch_user"
+    if not isinstance(query, str) or not query.strip():
+        return {"index": index, "status": "error", "user_id": user_id, "message": "'query' フィールドがありません。"}
+
+    started = time.time()
+    # 複数のバッチが同時に来ても、Difyへの同時問い合わせ数は BATCH_MAX_CONCURRENCY に抑える
+    with BATCH_DIFY_SEMAPHORE:
+        ok, ai_response_text = request_dify_answer(query)
+    if not ok:
+        # 失敗時のフォールバック文は回答として扱わない (Outgoing Webhook にも送らない)
+        return {
+            "index": index,
+            "status": "error",
+            "user_id": user_id,
+            "query": query,
+            "message": ai_response_text,
+            "elapsed": round(time.time() - started, 3)
+        }
+
+    if send_webhook and ENABLE_OUTGOING_WEBHOOK:
+        send_outgoing_webhook_async(user_prompt=query, ai_response=ai_response_text, user_id=user_id, source="batch")
+
+    return {
+        "index": index,
+        "status": "success",
+        "user_id": user_id,
+        "query": query,
+        "agent_response": ai_response_text,
+        "elapsed": round(time.time() - started, 3)
+    }
+
+
+def iter_batch_responses(items, max_workers=None, send_webhook=False):
+    """
+    複数のプロンプトを並列にDifyへ問い合わせ、完了した順に結果を返すジェネレータ
+    (音声出力を行わないため PROCESS_LOCK は取得しない)
+    
+    Args:
+        items (list): {"query": str, "user_id": str} の配列
+        max_workers (int): 同時実行数 (BATCH_MAX_CONCURRENCY が上限)
+        send_webhook (bool): 各結果を Outgoing Webhook で送信するか
+    
+    Yields:
+        dict: index (入力配列の位置) を含む1件分の結果
+    """
+    workers = min(max_workers or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY, len(items)) or 1
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-dify")
+    try:
+        futures = [executor.submit(_process_batch_item, i, item, send_webhook) for i, item in enumerate(items)]
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"❌ バッチ処理中に予期せぬエラー: {e}")
+                yield {"index": futures.index(future), "status": "error", "message": "内部エラーが発生しました。"}
+    finally:
+        # クライアント切断時などは未着手の問い合わせを破棄する
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 # ==========================================================
 # 6. 独立したマイク監視/アイドルチャットスレッドの関数
 # ==========================================================
@@ -555,32 +899,45 @@ def mic_listening_process_core():
                 continue 
         
         # --- マイク入力処理 ---
-        audio_path = recognize_speech_from_mic()
-        if audio_path is None: time.sleep(0.5); continue
+        # ★ Watson ストリーミング有効時は録音と並行して認識を完了させる (WAVファイルを経由しない)
+        streaming_stt = watson_streaming_available()
+        if streaming_stt:
+            streamed_text, streaming_failed, audio_path = watson_streaming_speech_to_text()
+            if streaming_failed:
+                # 通信失敗時は、録音済みの同じ発話を従来のファイル方式 (speech_to_text の優先順位) で認識する
+                # (ストリーム開始前に失敗し録音が無い場合のみ、改めて録音する)
+                streaming_stt = False
+                if audio_path is None: audio_path = recognize_speech_from_mic()
+                if audio_path is None: time.sleep(0.5); continue
+            elif streamed_text is None: time.sleep(0.5); continue
+        else:
+            audio_path = recognize_speech_from_mic()
+            if audio_path is None: time.sleep(0.5); continue
             
         # --- STTと応答処理の実行 (ロックが必要な部分) ---
         if PROCESS_LOCK.acquire(blocking=True, timeout=1): # 1秒待機してロックを取得
             try:
-                # マイク入力後のSTT処理
-                user_text = speech_to_text(audio_path) 
+                # マイク入力後のSTT処理 (ストリーミング時は認識済み)
+                user_text = streamed_text if streaming_stt else speech_to_text(audio_path) 
+                if not streaming_stt: annotate_corpus_utterance(user_text)
                 if user_text is None: time.sleep(0.5); continue
                     
                 # 起動キーワードチェック
-                processed_text = user_text.lower().strip()
+                # ★ Watson は単語間にスペースを入れるため、スペースを除いた文字列で判定する
+                processed_text = _normalize_wake_text(user_text)
                 triggered = False; final_prompt = None
                 
                 for wake_word_key in WAKE_WORD_SET:
-                    if processed_text.startswith(wake_word_key):
-                        triggered = True; final_prompt = user_text[len(wake_word_key):].strip()
-                        if len(user_text.strip()) > len(wake_word_key.strip()): final_prompt = user_text[len(wake_word_key):].strip()
-                        else: final_prompt = "何かご用でしょうか?" 
+                    if processed_text.startswith(_normalize_wake_text(wake_word_key)):
+                        triggered = True; final_prompt = _strip_wake_word(user_text, wake_word_key)
+                        if not final_prompt: final_prompt = "何かご用でしょうか?" 
                         break 
 
                 if triggered:
                     prompt = final_prompt
                     
                     # 休憩キーワードの検出
-                    if QUIET_KEYWORD.lower() in processed_text:
+                    if _normalize_wake_text(QUIET_KEYWORD) in processed_text:
                         quiet_mode_until_time = time.time() + QUIET_DURATION_MINUTES * 60
                         text_to_speech(f"承知いたしました。{QUIET_DURATION_MINUTES}分間、小声で口ずさんで休憩していますね。ご集中ください。")
                         last_interaction_time = time.time()
@@ -605,4 +962,110 @@ def mic_listening_process_core():
         else:
             # ロック取得に失敗した場合(WebHookが処理中)、今回の音声入力をスキップ
             print("警告: WebHook処理中のため、マイク入力後の応答処理をスキップしました。")
-            time.sleep(0.1)
\ No newline at end of file
+            time.sleep(0.1)
+
+
+# ==========================================================
+# ★ 7. プロファイリング関連関数 (管理者用エンドポイントから呼び出される)
+# ==========================================================
+
+# サンプリングプロファイラの状態 (_profiler_lock で保護)
+_profiler_lock = threading.Lock()
+_profiler_state = {
+    "running": False, "started_at": None, "finished_at": None,
+    "seconds": 0, "interval": 0.0, "samples": 0, "stacks": {}
+}
+
+# f_code ごとの表示ラベルのキャッシュ (サンプリング中は文字列整形を行わない)
+_frame_label_cache = {}
+
+def _format_code(code):
+    """コードオブジェクトを flamegraph 用の '関数名 (ファイル名:行番号)' 形式に変換する"""
+    label = _frame_label_cache.get(code)
+    if label is None:
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        _frame_label_cache[code] = label
+    return label
+
+def _sampling_profiler_loop(seconds, interval):
+    """全スレッドのスタックを一定間隔で採取し、(スレッド名, f_code の列) ごとに集計する"""
+    own_ident = threading.get_ident()
+    stacks = {}; samples = 0
+    deadline = time.time() + seconds
+
+    try:
+        while time.time() < deadline:
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident: continue  # プロファイラ自身は除外
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code); frame = frame.f_back
+                key = (thread_names.get(ident, f"thread-{ident}"), tuple(codes))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            time.sleep(interval)
+    except Exception as e:
+        print(f"❌ サンプリングプロファイラで予期せぬエラー: {e}")
+    finally:
+        # 例外時も必ず計測中フラグを解除する (解除しないと以降の計測が 409 になる)
+        with _profiler_lock:
+            _profiler_state.update(running=False, finished_at=time.time(), samples=samples, stacks=stacks)
+        print(f"📊 サンプリングプロファイラ終了: {samples} サンプル")
+
+def start_sampling_profiler(seconds, interval=PROFILE_DEFAULT_INTERVAL):
+    """
+    全スレッド (マイク監視, Flask, Outgoing Webhook) を対象にサンプリングプロファイラを起動する
+
+    Args:
+        seconds (float): 計測時間 (秒)
+        interval (float): サンプリング間隔 (秒)
+
+    Returns:
+        bool: 起動成功時True、既に計測中の場合False
+    """
+    with _profiler_lock:
+        if _profiler_state["running"]: return False
+        _profiler_state.update(
+            running=True, started_at=time.time(), finished_at=None,
+            seconds=seconds, interval=interval, samples=0, stacks={}
+        )
+
+    print(f"📊 サンプリングプロファイラ開始: {seconds}秒 (間隔 {interval}秒)")
+    thread = threading.Thread(
+        target=_sampling_profiler_loop,
+        args=(seconds, interval),
+        daemon=True,
+        name="sampling-profiler"
+    )
+    thread.start()
+    return True
+
+def get_sampling_profiler_status():
+    """サンプリングプロファイラの状態 (スタック本体を除く) を返す"""
+    with _profiler_lock:
+        status = {k: v for k, v in _profiler_state.items() if k != "stacks"}
+        status["unique_stacks"] = len(_profiler_state["stacks"])
+    return status
+
+def get_sampling_profile_collapsed():
+    """直近の計測結果を flamegraph.pl / speedscope 互換の collapsed-stack テキストで返す"""
+    with _profiler_lock: stacks = dict(_profiler_state["stacks"])
+    lines = {}
+    for (thread_name, codes), count in stacks.items():
+        line = ";".join([thread_name] + [_format_code(code) for code in reversed(codes)])
+        lines[line] = lines.get(line, 0) + count
+    return "\n".join(f"{line} {count}" for line, count in sorted(lines.items())) + "\n"
+
+def profile_call(func, *args, **kwargs):
+    """
+    cProfile で関数呼び出しを計測する (呼び出し元スレッドのみが対象)
+
+    Returns:
+        tuple: (関数の戻り値, pstats テキスト)
+    """
+    profiler = cProfile.Profile()
+    result = profiler.runcall(func, *args, **kwargs)
+    stats_stream = io.StringIO()
+    pstats.Stats(profiler, stream=stats_stream).sort_stats("cumulative").print_stats(PROFILE_STATS_LIMIT)
+    return result, stats_stream.getvalue()
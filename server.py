@@ -4,7 +4,9 @@ import os
 import sys
 import threading
 import time
-from flask import Flask, request, jsonify
+import hmac
+import json
+from flask import Flask, request, jsonify, Response
 
 # ★ agent_core.py からすべての必要な関数とグローバル変数をインポート
 import agent_core 
@@ -13,14 +15,46 @@ import agent_core
 SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
 SERVER_PORT = int(os.getenv("SERVER_PORT", "8080"))
 app = Flask(__name__)
+
+# ★ Incoming Webhook 同士を直列化するロック (threaded=True でも従来どおり1件ずつ順番に処理する)
+WEBHOOK_LOCK = threading.Lock()
 # -----------------------------
 
 
+# --- 管理者認証 ---
+def _is_admin_request():
+    """Authorization: Bearer <ADMIN_API_TOKEN> を検証する (トークン未設定時は常に拒否)"""
+    if not agent_core.ADMIN_API_TOKEN:
+        return False
+    expected = f"Bearer {agent_core.ADMIN_API_TOKEN}"
+    # 非ASCII文字を含む str は compare_digest が TypeError になるため bytes で比較する
+    provided = request.headers.get("Authorization", "")
+    return hmac.compare_digest(provided.encode("utf-8"), expected.encode("utf-8"))
+
+def _admin_forbidden():
+    return jsonify({
+        "status": "error",
+        "message": "管理者トークンが無効です。ADMIN_API_TOKEN を確認してください。"
+    }), 403
+
+
 # ★★★ 外部APIエンドポイントの定義 ★★★
 @app.route('/api/incoming-webhook', methods=['POST'])
 def handle_external_webhook():
     """外部WebアプリからJSONを受け取り、Dify経由で音声を出力するエンドポイント"""
+    # 連続して届いた Webhook は 503 にせず、先行の処理 (Dify + 発話) の完了を待って順番に処理する
+    # PROCESS_LOCK の 3秒タイムアウトは、マイク監視スレッドとの競合にのみ適用される
+    with WEBHOOK_LOCK:
+        return _process_external_webhook()
+
+def _process_external_webhook():
+    """Incoming Webhook の本処理 (WEBHOOK_LOCK を保持した状態で呼び出される)"""
     
+    # ★ X-Profile: 1 ヘッダーがあれば cProfile で処理を計測する (管理者のみ)
+    profile_requested = request.headers.get("X-Profile", "").strip() == "1"
+    if profile_requested and not _is_admin_request():
+        return _admin_forbidden()
+
     # 1. ロックの取得 (agent_coreのロックを参照)
     # ★ 修正: タイムアウトを 3秒に延長し、アイドルチャットを確実に中断させて WebHook処理を優先する
     if not agent_core.PROCESS_LOCK.acquire(timeout=3): # 3秒待ってロックが取れなければ 503
@@ -47,17 +81,25 @@ def handle_external_webhook():
         
         # 3. ★ 応答生成と発話 (キーワード引数で明示的に指定)
         # agent_core.process_and_respond_core は内部でDify通信、TTS、Outgoing Webhookを実行
-        ai_response_text = agent_core.process_and_respond_core(
-            user_prompt=query,      # ★ 明示的に指定
-            user_id=user_id, 
-            source="webhook"        # ★ Incoming Webhookからの入力として識別
-        )
+        core_kwargs = {
+            "user_prompt": query,   # ★ 明示的に指定
+            "user_id": user_id,
+            "source": "webhook"     # ★ Incoming Webhookからの入力として識別
+        }
+        profile_text = None
+        if profile_requested:
+            ai_response_text, profile_text = agent_core.profile_call(agent_core.process_and_respond_core, **core_kwargs)
+        else:
+            ai_response_text = agent_core.process_and_respond_core(**core_kwargs)
         
         # 4. 成功応答
-        return jsonify({
+        response_body = {
             "status": "success",
             "agent_response": ai_response_text
-        }), 200
+        }
+        if profile_text is not None:
+            response_body["profile"] = profile_text
+        return jsonify(response_body), 200
 
     except Exception as e:
         print(f"❌ 外部POST処理中に予期せぬエラー: {e}")
@@ -74,6 +116,52 @@ def handle_external_webhook():
              agent_core.PROCESS_LOCK.release()
 
 
+# ★★★ バッチ問い合わせエンドポイント ★★★
+@app.route('/api/batch-query', methods=['POST'])
+def handle_batch_query():
+    """複数のクエリを並列にDifyへ問い合わせ、完了した順に NDJSON でストリーミング返却する (音声出力なし)"""
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return jsonify({
+            "status": "error",
+            "message": "JSONデータに 'items' 配列 ({query, user_id} の配列) がありません。"
+        }), 400
+    if len(items) > agent_core.BATCH_MAX_ITEMS:
+        return jsonify({
+            "status": "error",
+            "message": f"'items' は最大{agent_core.BATCH_MAX_ITEMS}件までです。"
+        }), 400
+
+    try:
+        concurrency = int(data.get('concurrency', agent_core.BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        concurrency = agent_core.BATCH_MAX_CONCURRENCY
+    # Node-RED などが送る文字列 "false" を True と誤解しないよう、JSONの真偽値のみ受け付ける
+    send_webhook = data.get('outgoing_webhook', False)
+    if not isinstance(send_webhook, bool):
+        return jsonify({
+            "status": "error",
+            "message": "'outgoing_webhook' は true / false (JSONの真偽値) で指定してください。"
+        }), 400
+
+    print(f"\n🌐 バッチ受信: {len(items)}件 (同時実行数 {min(max(concurrency, 1), agent_core.BATCH_MAX_CONCURRENCY)})")
+
+    def generate():
+        started = time.time(); completed = 0
+        for result in agent_core.iter_batch_responses(items, max_workers=max(concurrency, 1), send_webhook=send_webhook):
+            completed += 1
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        yield json.dumps({
+            "status": "done",
+            "count": completed,
+            "elapsed": round(time.time() - started, 3)
+        }, ensure_ascii=False) + "\n"
+
+    return Response(generate(), mimetype="application/x-ndjson"), 200
+
+
 # ★★★ ヘルスチェックエンドポイント (オプション) ★★★
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -87,17 +175,72 @@ def health_check():
             "tts_watson": agent_core.ENABLE_WATSON_TTS,
             "stt_whisper_local": agent_core.ENABLE_WHISPER_LOCAL,
             "stt_watson": agent_core.ENABLE_WATSON_STT,
+            "stt_watson_streaming": agent_core.ENABLE_WATSON_STT_STREAMING,
             "stt_openai": agent_core.ENABLE_OPENAI_STT,
             "outgoing_webhook": agent_core.ENABLE_OUTGOING_WEBHOOK
         }
     }), 200
 
 
+# ★★★ プロファイリングエンドポイント (管理者のみ) ★★★
+@app.route('/api/admin/profile', methods=['POST'])
+def start_profile():
+    """全スレッドを対象としたサンプリングプロファイラをバックグラウンドで N 秒間起動する"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 10))
+        interval = float(data.get('interval', agent_core.PROFILE_DEFAULT_INTERVAL))
+    except (TypeError, ValueError):
+        return jsonify({
+            "status": "error",
+            "message": "'seconds' と 'interval' は数値で指定してください。"
+        }), 400
+
+    if not (0 < seconds <= agent_core.PROFILE_MAX_SECONDS) or not (0.001 <= interval <= 1.0):
+        return jsonify({
+            "status": "error",
+            "message": f"'seconds' は 0〜{agent_core.PROFILE_MAX_SECONDS}、'interval' は 0.001〜1.0 の範囲で指定してください。"
+        }), 400
+
+    # 計測中も他のリクエストを処理できるよう、計測はバックグラウンドで行い結果は GET で取得する
+    if not agent_core.start_sampling_profiler(seconds, interval):
+        return jsonify({
+            "status": "error",
+            "message": "プロファイラは既に計測中です。"
+        }), 409
+
+    return jsonify({
+        "status": "started",
+        "profiler": agent_core.get_sampling_profiler_status()
+    }), 202
+
+
+@app.route('/api/admin/profile', methods=['GET'])
+def get_profile():
+    """直近のサンプリング結果を collapsed-stack 形式 (flamegraph.pl / speedscope 互換) で返す"""
+    if not _is_admin_request():
+        return _admin_forbidden()
+
+    status = agent_core.get_sampling_profiler_status()
+    if status["running"]:
+        return jsonify({"status": "running", "profiler": status}), 202
+    if not status["samples"]:
+        return jsonify({
+            "status": "error",
+            "message": "計測結果がありません。先に POST /api/admin/profile で計測を開始してください。"
+        }), 404
+
+    return Response(agent_core.get_sampling_profile_collapsed(), mimetype="text/plain"), 200
+
+
 # ★★★ メインエントリポイント ★★★
 if __name__ == "__main__":
     
     # 1. 音声入力監視スレッドを起動
-    mic_thread = threading.Thread(target=agent_core.mic_listening_process_core, daemon=True)
+    mic_thread = threading.Thread(target=agent_core.mic_listening_process_core, daemon=True, name="mic-listener")
     mic_thread.start() 
 
     # 2. Webサーバーをメインスレッドで起動
@@ -108,13 +251,18 @@ if __name__ == "__main__":
         print("==================================================")
         print("      📢 ハイブリッド AI エージェント起動中 📢      ")
         print(f"🌐 Webhook受付中: http://{SERVER_HOST}:{SERVER_PORT}/api/incoming-webhook")
+        print(f"📦 バッチ問い合わせ: http://{SERVER_HOST}:{SERVER_PORT}/api/batch-query")
         print(f"💚 ヘルスチェック: http://{SERVER_HOST}:{SERVER_PORT}/health")
+        if agent_core.ADMIN_API_TOKEN:
+            print(f"📊 プロファイラ(管理者): http://{SERVER_HOST}:{SERVER_PORT}/api/admin/profile")
         if agent_core.ENABLE_OUTGOING_WEBHOOK:
             print(f"📤 Outgoing Webhook: {agent_core.OUTGOING_WEBHOOK_URL}")
         print("==================================================")
         
         # Flaskを本番に近い設定で実行
-        app.run(host=SERVER_HOST, port=SERVER_PORT, threaded=False, debug=False, use_reloader=False)
+        # ★ threaded=True: バッチのストリーミング中も Webhook / ヘルスチェック / プロファイラに応答する
+        #   /api/incoming-webhook 同士は WEBHOOK_LOCK で直列化され、マイク監視とは PROCESS_LOCK で排他制御される
+        app.run(host=SERVER_HOST, port=SERVER_PORT, threaded=True, debug=False, use_reloader=False)
 
     except KeyboardInterrupt:
         print("\nプログラムを中断しました。")
@@ -0,0 +1,260 @@
+# stt_benchmark.py
+#
+# 録音済みの発話コーパス (STT_CORPUS_DIR) をローカル Whisper で再認識し、
+# モデル / compute_type / スレッド数 / vad_filter の組み合わせごとに
+# レイテンシ、リアルタイム係数 (RTF)、CPU使用率、ピークメモリ、文字誤り率 (CER) を計測する。
+#
+# 使い方 (例):
+#   python stt_benchmark.py --corpus stt_corpus --models tiny,base,small --compute-types int8,float32 --threads 0,4 --vad on,off
+#
+# ★ Watson / OpenAI はローカルスタブに差し替えるため、ネットワーク通信は発生しない
+
+import os
+import sys
+import re
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# ==========================================================
+# 1. コーパス読み込みと評価指標
+# ==========================================================
+
+def load_corpus(corpus_dir):
+    """コーパスディレクトリから (メタデータJSON + WAV) の組を読み込む"""
+    entries = []
+    if not os.path.isdir(corpus_dir): return entries
+    for name in sorted(os.listdir(corpus_dir)):
+        if not name.endswith(".json"): continue
+        try:
+            with open(os.path.join(corpus_dir, name), "r", encoding="utf-8") as f: metadata = json.load(f)
+        except Exception as e:
+            print(f"警告: メタデータの読み込みに失敗しました ({name})。詳細: {e}"); continue
+        audio_path = os.path.join(corpus_dir, metadata.get("audio_file") or name[:-len(".json")] + ".wav")
+        if not os.path.exists(audio_path): continue
+        metadata["audio_path"] = audio_path
+        entries.append(metadata)
+    return entries
+
+def _normalize_for_cer(text):
+    """CER計測用に空白と句読点を除去する (長音記号などの文字は残す)"""
+    return re.sub(r"[\s、。,.!?！？「」『』（）()…・]", "", (text or "").lower())
+
+def character_error_rate(reference, hypothesis):
+    """文字誤り率 (編集距離 / 正解文字数) を返す"""
+    ref = _normalize_for_cer(reference); hyp = _normalize_for_cer(hypothesis)
+    if not ref: return None
+    previous = list(range(len(hyp) + 1))
+    for i, ref_char in enumerate(ref, 1):
+        current = [i]
+        for j, hyp_char in enumerate(hyp, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_char != hyp_char)))
+        previous = current
+    return previous[-1] / len(ref)
+
+def percentile(values, q):
+    """線形補間でパーセンタイル値を返す (q: 0〜100)"""
+    if not values: return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position); upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def _peak_rss_mb():
+    """プロセスのピークメモリ使用量 (MB) を返す。取得できない環境では None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil  # Windows ではオプションの psutil を利用
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except Exception:
+        return None
+
+
+# ==========================================================
+# 2. Watson / OpenAI のローカルスタブ
+# ==========================================================
+
+class _StubResult:
+    def __init__(self, result): self._result = result
+    def get_result(self): return self._result
+
+class _StubWatsonSTT:
+    """SpeechToTextV1 のローカルスタブ (常に「認識結果なし」を返す)"""
+    def recognize(self, *args, **kwargs): return _StubResult({"results": []})
+    def recognize_using_websocket(self, *args, **kwargs): return None
+
+class _StubOpenAITranscriptions:
+    def create(self, *args, **kwargs):
+        return type("Transcript", (), {"text": ""})()
+
+class _StubOpenAIClient:
+    """OpenAI クライアントのローカルスタブ (常に空の認識結果を返す)"""
+    def __init__(self):
+        self.audio = type("Audio", (), {"transcriptions": _StubOpenAITranscriptions()})()
+
+
+# ==========================================================
+# 3. ベンチマーク実行 (設定ごとに別プロセスで実行し、メモリ計測を分離する)
+# ==========================================================
+
+def _run_config(config, entries, repeat, warmup):
+    """1つの設定 (モデル, compute_type, スレッド数, vad_filter) でコーパス全体を認識する"""
+    # agent_core の初期化で外部サービスやデフォルトモデルを読み込まないようにする
+    for key in ("ENABLE_WHISPER_LOCAL", "ENABLE_WATSON_STT", "ENABLE_OPENAI_STT", "ENABLE_DIFY", "ENABLE_OUTGOING_WEBHOOK"):
+        os.environ[key] = "False"
+    os.environ["STT_CORPUS_DIR"] = ""
+    import agent_core
+
+    agent_core.stt_service = _StubWatsonSTT()
+    agent_core.openai_client = _StubOpenAIClient()
+
+    load_started = time.perf_counter()
+    agent_core.whisper_local_model = agent_core.WhisperModel(
+        config["model"], device="cpu", compute_type=config["compute_type"], cpu_threads=config["cpu_threads"]
+    )
+    load_sec = time.perf_counter() - load_started
+
+    for _ in range(warmup):
+        agent_core.whisper_speech_to_text(entries[0]["audio_path"], vad_filter=config["vad_filter"])
+
+    latencies = []; rtfs = []; cers = []; cpu_utilizations = []; transcripts = []
+    for entry in entries:
+        for _ in range(repeat):
+            wall_started = time.perf_counter(); cpu_started = time.process_time()
+            text = agent_core.whisper_speech_to_text(entry["audio_path"], vad_filter=config["vad_filter"])
+            wall = time.perf_counter() - wall_started; cpu = time.process_time() - cpu_started
+
+            latencies.append(wall)
+            if entry.get("duration_sec"): rtfs.append(wall / entry["duration_sec"])
+            if wall > 0: cpu_utilizations.append(cpu / wall)
+        cer = character_error_rate(entry.get("reference"), text)
+        if cer is not None: cers.append(cer)
+        transcripts.append({"id": entry.get("id"), "reference": entry.get("reference"), "hypothesis": text, "cer": cer})
+
+    return {
+        "config": config,
+        "utterances": len(entries),
+        "runs": len(latencies),
+        "model_load_sec": round(load_sec, 3),
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p99": percentile(latencies, 99),
+        "rtf_mean": sum(rtfs) / len(rtfs) if rtfs else None,
+        "cpu_utilization_mean": sum(cpu_utilizations) / len(cpu_utilizations) if cpu_utilizations else None,
+        "peak_rss_mb": _peak_rss_mb(),
+        "cer_mean": sum(cers) / len(cers) if cers else None,
+        "cer_count": len(cers),
+        "transcripts": transcripts
+    }
+
+def run_benchmark(entries, configs, repeat=1, warmup=1):
+    """全設定を順番に (1設定1プロセスで) 実行して結果のリストを返す"""
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for config in configs:
+        label = _config_label(config)
+        print(f"▶ 計測中: {label}")
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results.append(executor.submit(_run_config, config, entries, repeat, warmup).result())
+        except Exception as e:
+            print(f"❌ 計測に失敗しました ({label})。詳細: {e}")
+            results.append({"config": config, "error": str(e)})
+    return results
+
+
+# ==========================================================
+# 4. レポート出力とコマンドライン
+# ==========================================================
+
+def _config_label(config):
+    threads = config["cpu_threads"] or "auto"
+    return f"{config['model']} / {config['compute_type']} / threads={threads} / vad={'on' if config['vad_filter'] else 'off'}"
+
+def _fmt(value, digits=3):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+def print_report(results):
+    """結果を表形式で標準出力に表示する"""
+    header = f"{'設定':<48} {'p50(s)':>8} {'p90(s)':>8} {'p99(s)':>8} {'RTF':>6} {'CPU':>6} {'RSS(MB)':>8} {'CER':>6}"
+    print("\n" + header); print("-" * len(header))
+    for result in results:
+        label = _config_label(result["config"])
+        if "error" in result:
+            print(f"{label:<48} エラー: {result['error']}"); continue
+        print(
+            f"{label:<48} {_fmt(result['latency_p50']):>8} {_fmt(result['latency_p90']):>8} {_fmt(result['latency_p99']):>8}"
+            f" {_fmt(result['rtf_mean'], 2):>6} {_fmt(result['cpu_utilization_mean'], 2):>6}"
+            f" {_fmt(result['peak_rss_mb'], 0):>8} {_fmt(result['cer_mean']):>6}"
+        )
+
+def _split(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+def _thread_list(value):
+    """--threads の値 (カンマ区切りの 0 以上の整数、auto は 0) を検証する"""
+    threads = []
+    for item in _split(value):
+        if item.lower() == "auto": threads.append(0); continue
+        try: count = int(item)
+        except ValueError: raise argparse.ArgumentTypeError(f"スレッド数は整数または auto で指定してください: {item}")
+        if count < 0: raise argparse.ArgumentTypeError(f"スレッド数は 0 以上で指定してください: {item}")
+        threads.append(count)
+    if not threads: raise argparse.ArgumentTypeError("スレッド数を1つ以上指定してください。")
+    return threads
+
+def _vad_list(value):
+    """--vad の値 (カンマ区切りの on / off) を検証する"""
+    choices = {"on": True, "true": True, "1": True, "off": False, "false": False, "0": False}
+    vads = []
+    for item in _split(value):
+        if item.lower() not in choices: raise argparse.ArgumentTypeError(f"vad_filter は on / off で指定してください: {item}")
+        vads.append(choices[item.lower()])
+    if not vads: raise argparse.ArgumentTypeError("vad_filter を1つ以上指定してください。")
+    return vads
+
+def main():
+    parser = argparse.ArgumentParser(description="発話コーパスを使ったローカル Whisper STT のベンチマーク")
+    parser.add_argument("--corpus", default=os.getenv("STT_CORPUS_DIR") or "stt_corpus", help="コーパスディレクトリ (既定: STT_CORPUS_DIR)")
+    parser.add_argument("--models", default=os.getenv("WHISPER_LOCAL_MODEL") or "tiny", help="モデル名 (カンマ区切り)")
+    parser.add_argument("--compute-types", default="int8", help="compute_type (カンマ区切り, 例: int8,int8_float32,float32)")
+    parser.add_argument("--threads", type=_thread_list, default=[0], help="cpu_threads (カンマ区切り, 0 または auto は自動)")
+    parser.add_argument("--vad", type=_vad_list, default=[True], help="vad_filter (カンマ区切り, on / off)")
+    parser.add_argument("--repeat", type=int, default=1, help="1発話あたりの計測回数")
+    parser.add_argument("--warmup", type=int, default=1, help="計測前のウォームアップ回数")
+    parser.add_argument("--limit", type=int, default=0, help="使用する発話数の上限 (0 は全件)")
+    parser.add_argument("--output", help="結果を JSON で保存するファイルパス")
+    args = parser.parse_args()
+
+    entries = load_corpus(args.corpus)
+    if args.limit > 0: entries = entries[:args.limit]
+    if not entries:
+        print(f"エラー: コーパスが見つかりません: {args.corpus} (STT_CORPUS_DIR を設定して録音してください)"); sys.exit(1)
+
+    configs = [
+        {"model": model, "compute_type": compute_type, "cpu_threads": threads, "vad_filter": vad_filter}
+        for model, compute_type, threads, vad_filter in itertools.product(
+            _split(args.models), _split(args.compute_types), args.threads, args.vad
+        )
+    ]
+    print(f"📊 コーパス: {len(entries)}件 / 設定: {len(configs)}通り")
+
+    results = run_benchmark(entries, configs, repeat=max(args.repeat, 1), warmup=max(args.warmup, 0))
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果を保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()